@@ -4,16 +4,36 @@ import os
 # گرفتن آدرس دیتابیس از Environment Variables
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-# نگه داشتن pool اتصال‌ها
+# اندازه pool از Environment قابل تنظیم است
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "10"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "50"))
+
+# نگه داشتن pool اتصال‌ها (تنها pool مشترک کل برنامه)
 pool = None
 
-async def init_db():
+async def init_db(min_size: int = None, max_size: int = None):
     global pool
     if pool is None:
-        pool = await asyncpg.create_pool(DATABASE_URL)
+        pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=min_size if min_size is not None else DB_POOL_MIN,
+            max_size=max_size if max_size is not None else DB_POOL_MAX,
+            max_inactive_connection_lifetime=300,
+            command_timeout=10,
+            statement_cache_size=1024,
+            max_cached_statement_lifetime=0,  # آماده‌سازی‌شده‌ها هرگز منقضی نشوند
+            server_settings={"jit": "off"},  # کوئری‌ها کوچک‌اند؛ JIT فقط سربار دارد
+        )
+    return pool
 
 async def get_pool():
     global pool
     if pool is None:
         await init_db()
     return pool
+
+async def close_pool():
+    global pool
+    if pool is not None:
+        await pool.close()
+        pool = None
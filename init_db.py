@@ -1,33 +1,17 @@
 import asyncio
-from db import get_pool, init_db
-
-CREATE_TABLES = """
-CREATE TABLE IF NOT EXISTS users (
-    id SERIAL PRIMARY KEY,
-    telegram_id BIGINT UNIQUE NOT NULL,
-    username TEXT,
-    joined_at TIMESTAMP DEFAULT NOW()
-);
+import pathlib
 
-CREATE TABLE IF NOT EXISTS links (
-    id SERIAL PRIMARY KEY,
-    url TEXT NOT NULL,
-    created_at TIMESTAMP DEFAULT NOW(),
-    expires_in INTEGER DEFAULT 20  -- ثانیه، پیش‌فرض ۲۰
-);
+from db import get_pool, init_db
 
-CREATE TABLE IF NOT EXISTS settings (
-    id SERIAL PRIMARY KEY,
-    name TEXT UNIQUE NOT NULL,
-    value TEXT NOT NULL
-);
-"""
+# اسکیمای اصلی برنامه در schema.sql نگه‌داری می‌شود
+SCHEMA_PATH = pathlib.Path(__file__).with_name("schema.sql")
 
 async def main():
     await init_db()
     pool = await get_pool()
+    schema = SCHEMA_PATH.read_text(encoding="utf-8")
     async with pool.acquire() as conn:
-        await conn.execute(CREATE_TABLES)
+        await conn.execute(schema)
         print("✅ Tables created successfully")
 
 if __name__ == "__main__":
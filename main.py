@@ -1,23 +1,40 @@
 # main.py
 import os
 import asyncio
+import base64
+import heapq
 import hmac
-import hashlib
+import itertools
 import logging
+import logging.handlers
+import queue
+import secrets
 import time
+from collections import defaultdict
+from datetime import datetime
 from typing import Optional, List, Dict, Any
 
 import asyncpg
-from fastapi import FastAPI, Request, Header
-from starlette.responses import JSONResponse
+import orjson
+from fastapi import FastAPI, Request, Header, Response
+from fastapi.responses import ORJSONResponse
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.filters import Command, CommandObject, CommandStart
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram import exceptions as tg_excs
 
+from db import init_db, get_pool, close_pool
+
 # ----------------------------
 # Logging
 # ----------------------------
-logging.basicConfig(level=logging.INFO)
+# stderr writes happen on a background thread so log calls on the hot path
+# never block the event loop
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(_log_queue)])
+_log_listener.start()
 log = logging.getLogger("uploader-bot")
 
 # ----------------------------
@@ -31,10 +48,11 @@ STORAGE_CHANNEL_ID = int(os.getenv("STORAGE_CHANNEL_ID", "0"))  # -100...
 DEFAULT_REQUIRED_CHANNEL_IDS = [int(x) for x in os.getenv("DEFAULT_REQUIRED_CHANNEL_IDS", "").split(",") if x.strip()]
 
 DATABASE_URL = os.getenv("DATABASE_URL")
-TOKEN_SECRET = os.getenv("TOKEN_SECRET", os.getenv("JWT_SECRET", "change_this_secret_please"))
 WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", os.getenv("RENDER_EXTERNAL_HOSTNAME", ""))  # e.g. https://your-app.onrender.com
 KEEPALIVE_SECRET = os.getenv("KEEPALIVE_SECRET", os.getenv("KEEPALIVE", ""))
 
+REDIS_URL = os.getenv("REDIS_URL", "")  # optional; enables shared rate-limit state across workers
+
 DEFAULT_DELETE_TIMEOUT = int(os.getenv("DELETE_TIMEOUT_DEFAULT", "20"))
 RATE_LIMIT_COUNT = int(os.getenv("RATE_LIMIT_COUNT", "6"))
 RATE_LIMIT_PERIOD = int(os.getenv("RATE_LIMIT_PERIOD", "60"))  # seconds
@@ -47,101 +65,325 @@ if not DATABASE_URL:
 if not WEBHOOK_BASE_URL:
     log.warning("WEBHOOK_BASE_URL not set; webhook may fail to configure correctly.")
 
-WEBHOOK_PATH = f"/webhook/{BOT_TOKEN}"
+# registered with set_webhook; Telegram sends it back on every update so we
+# can reject scraper traffic before parsing. Random per process if unset.
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+_WEBHOOK_SECRET_BYTES = WEBHOOK_SECRET.encode()
+
+# stable path; auth relies on the secret_token header, so the bot token
+# never shows up in proxy/access logs
+WEBHOOK_PATH = "/webhook"
 WEBHOOK_URL = WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH if WEBHOOK_BASE_URL else None
 
 # ----------------------------
-# DB pool (asyncpg)
+# DB pool (asyncpg) — shared pool lives in db.py
 # ----------------------------
-_db_pool: Optional[asyncpg.pool.Pool] = None
 
-async def get_db_pool():
-    global _db_pool
-    if _db_pool is None:
-        log.info("Creating asyncpg pool...")
-        _db_pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=10)
-    return _db_pool
+# Hot SQL lives in module constants: the exact query text is the key of
+# asyncpg's per-connection statement cache, so every call reuses the same
+# server-side prepared plan after first execution on a connection.
+# idempotent: re-posting a known file updates the row and keeps its token
+SQL_INSERT_FILE = """
+    INSERT INTO files (storage_chat_id, storage_message_id, file_unique_id, file_type, file_size, token, required_channels)
+    VALUES ($1,$2,$3,$4,$5,$6,$7)
+    ON CONFLICT (file_unique_id) DO UPDATE SET storage_message_id = EXCLUDED.storage_message_id
+    RETURNING id, token;
+"""
 
-# DB helpers
-async def insert_file_record(storage_chat_id:int, storage_message_id:int, file_unique_id:str, file_type:str, file_size:int, token:str, required_channels:List[int]=None):
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("""
-            INSERT INTO files (storage_chat_id, storage_message_id, file_unique_id, file_type, file_size, token, required_channels)
-            VALUES ($1,$2,$3,$4,$5,$6,$7)
-            RETURNING id;
-        """, storage_chat_id, storage_message_id, file_unique_id, file_type, file_size, token, required_channels or [])
-        return row['id']
-
-async def get_file_by_token(token:str):
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        return await conn.fetchrow("SELECT * FROM files WHERE token=$1 AND active=true", token)
+SQL_UPSERT_USER_AND_GET_FILE = """
+    WITH u AS (
+        INSERT INTO users (user_id, username, first_name, last_name, last_seen)
+        VALUES ($1,$2,$3,$4, now())
+        ON CONFLICT (user_id) DO UPDATE SET last_seen = now(), username = EXCLUDED.username
+    )
+    SELECT id, storage_chat_id, storage_message_id, required_channels
+    FROM files WHERE token=$5 AND active=true;
+"""
 
-async def increment_file_views(file_id:int):
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        await conn.execute("UPDATE files SET views = views + 1 WHERE id=$1", file_id)
+SQL_RECORD_DELIVERY = """
+    INSERT INTO deliveries (file_id, user_id, sent_message_id)
+    VALUES ($1,$2,$3)
+    RETURNING id;
+"""
 
-async def upsert_user(user_id:int, username:Optional[str], first_name:Optional[str], last_name:Optional[str]):
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO users (user_id, username, first_name, last_name, last_seen)
-            VALUES ($1,$2,$3,$4, now())
-            ON CONFLICT (user_id) DO UPDATE SET last_seen = now(), username = EXCLUDED.username;
-        """, user_id, username, first_name, last_name)
+SQL_FLUSH_VIEWS = "UPDATE files SET views = views + $2 WHERE id = $1"
+
+SQL_MARK_DELIVERIES_DELETED = "UPDATE deliveries SET deleted_at = now() WHERE id = ANY($1)"
+SQL_GET_SETTING = "SELECT value FROM settings WHERE key=$1"
+
+# local membership mirror, fed by chat_member updates
+SQL_MEMBER_CHANNELS = "SELECT channel_id FROM channel_members WHERE user_id=$1 AND channel_id = ANY($2)"
+SQL_MEMBER_ADD = "INSERT INTO channel_members (channel_id, user_id) VALUES ($1,$2) ON CONFLICT DO NOTHING"
+SQL_MEMBER_REMOVE = "DELETE FROM channel_members WHERE channel_id=$1 AND user_id=$2"
+
+# DB helpers — single-statement helpers go through the pool's own
+# fetch/execute shortcuts (acquire/release handled internally); only
+# multi-statement or executemany paths acquire explicitly
+async def insert_file_record(storage_chat_id:int, storage_message_id:int, file_unique_id:str, file_type:str, file_size:int, token:str, required_channels:List[int]=None):
+    pool = await get_pool()
+    # returns the pre-existing token when the file was already registered
+    return await pool.fetchrow(SQL_INSERT_FILE, storage_chat_id, storage_message_id, file_unique_id, file_type, file_size, token, required_channels or [])
+
+async def upsert_user_and_get_file(user_id:int, username:Optional[str], first_name:Optional[str], last_name:Optional[str], token:str):
+    # one round-trip: upsert the user and fetch the file row together
+    pool = await get_pool()
+    return await pool.fetchrow(SQL_UPSERT_USER_AND_GET_FILE, user_id, username, first_name, last_name, token)
 
 async def record_delivery(file_id:int, user_id:int, sent_message_id:int):
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("INSERT INTO deliveries (file_id, user_id, sent_message_id) VALUES ($1,$2,$3) RETURNING id;", file_id, user_id, sent_message_id)
-        return row['id']
+    pool = await get_pool()
+    row = await pool.fetchrow(SQL_RECORD_DELIVERY, file_id, user_id, sent_message_id)
+    # view bumps are coalesced in memory and flushed in one batch, so hot
+    # files take one row-lock per flush interval instead of one per download
+    _view_buf[file_id] += 1
+    return row['id']
 
-async def mark_delivery_deleted(delivery_id:int):
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        await conn.execute("UPDATE deliveries SET deleted_at = now() WHERE id=$1", delivery_id)
+# view-counter write coalescing
+VIEW_FLUSH_INTERVAL = int(os.getenv("VIEW_FLUSH_INTERVAL", "5"))  # seconds
+_view_buf: Dict[int, int] = defaultdict(int)
+
+async def _flush_views_once():
+    if not _view_buf:
+        return
+    snap = list(_view_buf.items())
+    _view_buf.clear()
+    pool = await get_pool()
+    try:
+        async with pool.acquire() as conn:
+            await conn.executemany(SQL_FLUSH_VIEWS, snap)
+    except Exception:
+        # put the counts back so a transient DB error doesn't lose views
+        for fid, n in snap:
+            _view_buf[fid] += n
+        raise
+
+_view_flusher_task: Optional[asyncio.Task] = None
+
+async def view_flusher():
+    while True:
+        await asyncio.sleep(VIEW_FLUSH_INTERVAL)
+        try:
+            await _flush_views_once()
+        except Exception as e:
+            log.warning("view flush failed: %s", e)
+
+async def get_known_memberships(user_id:int, channel_ids:List[int]) -> set:
+    # channels the mirror already confirms; the rest fall back to the API
+    pool = await get_pool()
+    rows = await pool.fetch(SQL_MEMBER_CHANNELS, user_id, channel_ids)
+    return {r['channel_id'] for r in rows}
+
+async def set_membership(channel_id:int, user_id:int, is_member:bool):
+    pool = await get_pool()
+    if is_member:
+        await pool.execute(SQL_MEMBER_ADD, channel_id, user_id)
+    else:
+        await pool.execute(SQL_MEMBER_REMOVE, channel_id, user_id)
+
+async def mark_deliveries_deleted(delivery_ids:List[int]):
+    if not delivery_ids:
+        return
+    pool = await get_pool()
+    await pool.execute(SQL_MARK_DELIVERIES_DELETED, delivery_ids)
 
 async def get_setting(key:str, default:Optional[str]=None):
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT value FROM settings WHERE key=$1", key)
-        return row['value'] if row else default
+    pool = await get_pool()
+    row = await pool.fetchrow(SQL_GET_SETTING, key)
+    return row['value'] if row else default
+
+# settings rarely change; cache reads in-process. Changes are pushed via
+# Postgres NOTIFY (see set_setting / _on_settings_changed), so the TTL is
+# only a safety net against missed notifications.
+SETTING_CACHE_TTL = 300  # seconds
+_setting_cache: Dict[str, Any] = {}  # key -> (expires_at, value)
+_settings_listen_conn = None  # dedicated LISTEN connection (not from the pool)
+
+def _on_settings_changed(conn, pid, channel, payload):
+    # payload is the key that changed; every worker drops its cached copy
+    _setting_cache.pop(payload, None)
+
+async def get_setting_cached(key:str, default:Optional[str]=None):
+    now_ts = time.time()
+    hit = _setting_cache.get(key)
+    if hit and hit[0] > now_ts:
+        return hit[1]
+    value = await get_setting(key, default)
+    _setting_cache[key] = (now_ts + SETTING_CACHE_TTL, value)
+    return value
 
 async def set_setting(key:str, value:str):
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        await conn.execute("INSERT INTO settings(key,value) VALUES($1,$2) ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value", key, value)
+    pool = await get_pool()
+    # upsert + notify in one round-trip; the NOTIFY fans the invalidation
+    # out to every worker listening on settings_changed
+    await pool.execute("""
+        WITH up AS (
+            INSERT INTO settings(key,value) VALUES($1,$2)
+            ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value
+        )
+        SELECT pg_notify('settings_changed', $1)
+    """, key, value)
+    _setting_cache.pop(key, None)
 
 # ----------------------------
 # Bot & Dispatcher
 # ----------------------------
-bot = Bot(token=BOT_TOKEN)  # aiogram 3.6 style
+# one shared keep-alive session for all outbound Telegram calls: a wider
+# connector plus a long DNS TTL so bursts don't stall on handshakes/lookups
+TELEGRAM_CONN_LIMIT = int(os.getenv("TELEGRAM_CONN_LIMIT", "100"))
+# aiogram decodes/encodes every Bot API payload through these hooks
+tg_session = AiohttpSession(json_loads=orjson.loads,
+                            json_dumps=lambda obj: orjson.dumps(obj).decode())
+# AiohttpSession has no public connector knobs in 3.6; these kwargs feed its TCPConnector
+tg_session._connector_init.update(limit=TELEGRAM_CONN_LIMIT,
+                                  limit_per_host=TELEGRAM_CONN_LIMIT,
+                                  ttl_dns_cache=300,
+                                  enable_cleanup_closed=True)
+
+bot = Bot(token=BOT_TOKEN, session=tg_session)  # aiogram 3.6 style
 dp = Dispatcher()
 
+# bot identity is immutable for the process lifetime; fetch it once
+_me: Optional[types.User] = None
+
+async def get_me_cached() -> types.User:
+    global _me
+    if _me is None:
+        _me = await bot.get_me()
+    return _me
+
 # ----------------------------
 # Utilities: token, rate-limit, safe send
 # ----------------------------
-def make_token(file_unique_id: str) -> str:
-    nonce = os.urandom(12)
-    digest = hmac.new(TOKEN_SECRET.encode(), file_unique_id.encode() + nonce, hashlib.sha256).hexdigest()
-    return digest[:36]
+# tokens are plain CSPRNG values (the old keyed MAC over a guessable
+# file_unique_id added nothing beyond its nonce); the UNIQUE constraint on
+# files.token guards the astronomical collision. Entropy is drawn in 4 KiB
+# batches so each token costs a slice + encode instead of a getrandom syscall.
+# Safe without a lock: make_token is sync and only runs on the event loop.
+_TOKEN_BYTES = 16
+_TOKEN_BUF_SIZE = 4096
+_token_buf = b""
+_token_off = 0
 
-_rate_map: Dict[int, List[float]] = {}
+def make_token() -> str:
+    global _token_buf, _token_off
+    if _token_off + _TOKEN_BYTES > len(_token_buf):
+        _token_buf = os.urandom(_TOKEN_BUF_SIZE)
+        _token_off = 0
+    raw = _token_buf[_token_off:_token_off + _TOKEN_BYTES]
+    _token_off += _TOKEN_BYTES
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
 
-def is_rate_limited(user_id: int) -> bool:
-    now_ts = time.time()
-    lst = _rate_map.get(user_id, [])
-    window_start = now_ts - RATE_LIMIT_PERIOD
-    lst = [t for t in lst if t >= window_start]
-    lst.append(now_ts)
-    _rate_map[user_id] = lst
-    return len(lst) > RATE_LIMIT_COUNT
+# Redis-backed limiter (shared across workers) with in-process fallback
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+_redis = None
+_rate_limit_script = None
+
+# atomic rolling window over a sorted set, one round-trip:
+# prune old hits, record this one, refresh the TTL, return the count
+_RATE_LIMIT_LUA = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, ARGV[1])
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return redis.call('ZCARD', KEYS[1])
+"""
+
+# after this many consecutive failures Redis is skipped for a cooldown
+# instead of re-probing (and paying its timeout) on every request
+_REDIS_FAIL_LIMIT = 3
+_REDIS_COOLDOWN = 30.0  # seconds
+_redis_failures = 0
+_redis_down_until = 0.0
+
+async def is_rate_limited(user_id: int) -> bool:
+    global _redis_failures, _redis_down_until
+    if _rate_limit_script is not None and time.monotonic() >= _redis_down_until:
+        try:
+            now_ts = time.time()
+            cnt = await _rate_limit_script(
+                keys=[f"rl:{user_id}"],
+                args=[now_ts - RATE_LIMIT_PERIOD, repr(now_ts), RATE_LIMIT_PERIOD])
+            _redis_failures = 0
+            return int(cnt) > RATE_LIMIT_COUNT
+        except Exception as e:
+            _redis_failures += 1
+            if _redis_failures >= _REDIS_FAIL_LIMIT:
+                _redis_failures = 0
+                _redis_down_until = time.monotonic() + _REDIS_COOLDOWN
+                log.warning("redis rate-limit down, local fallback for %ss: %s", _REDIS_COOLDOWN, e)
+            else:
+                log.warning("redis rate-limit failed, using local fallback: %s", e)
+    return _is_rate_limited_local(user_id)
+
+# token bucket: two floats per user instead of a timestamp deque — same
+# average rate (RATE_LIMIT_COUNT per RATE_LIMIT_PERIOD) at a fraction of
+# the memory, and each check is O(1) with no allocation
+_rate_map: Dict[int, Any] = {}  # uid -> (tokens, last_refill)
+RATE_MAP_MAX_USERS = int(os.getenv("RATE_MAP_MAX_USERS", "100000"))
+_RATE_REFILL_PER_SEC = RATE_LIMIT_COUNT / RATE_LIMIT_PERIOD
+
+# defaults bind the hot names once at definition time; time.monotonic is
+# immune to wall-clock jumps (NTP) that would drain or overfill buckets
+def _is_rate_limited_local(user_id: int, _now=time.monotonic, _map=_rate_map) -> bool:
+    now_ts = _now()
+    entry = _map.get(user_id)
+    if entry is None:
+        if len(_map) >= RATE_MAP_MAX_USERS:
+            # evict the oldest-inserted user so the map never exceeds the cap
+            # even between sweeper runs
+            _map.pop(next(iter(_map)))
+        tokens = float(RATE_LIMIT_COUNT)
+    else:
+        tokens, last = entry
+        tokens = min(RATE_LIMIT_COUNT, tokens + (now_ts - last) * _RATE_REFILL_PER_SEC)
+    if tokens < 1.0:
+        _map[user_id] = (tokens, now_ts)
+        return True
+    _map[user_id] = (tokens - 1.0, now_ts)
+    return False
+
+RATE_MAP_SWEEP_INTERVAL = 300  # seconds
+_rate_sweeper_task: Optional[asyncio.Task] = None
+
+async def sweep_rate_map():
+    # drop users whose window has fully expired so _rate_map stays bounded;
+    # expired membership-cache entries are pruned on the same cadence
+    while True:
+        await asyncio.sleep(RATE_MAP_SWEEP_INTERVAL)
+        # a bucket untouched for a full period has refilled; safe to drop
+        # (buckets are stamped with the monotonic clock, caches with wall time)
+        cutoff = time.monotonic() - RATE_LIMIT_PERIOD
+        stale = [uid for uid, (_, last) in _rate_map.items() if last < cutoff]
+        for uid in stale:
+            _rate_map.pop(uid, None)
+        now_ts = time.time()
+        expired = [k for k, v in _member_cache.items() if v[0] <= now_ts]
+        for k in expired:
+            _member_cache.pop(k, None)
+        stale_pages = [k for k, v in _links_page_cache.items() if v[0] <= now_ts]
+        for k in stale_pages:
+            _links_page_cache.pop(k, None)
+
+# cap concurrent outbound sends; this bounds in-flight requests, not the send
+# rate — broadcasts add their own msg/s pacing in _send_broadcast_page
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", "20"))
+_send_sem = asyncio.Semaphore(SEND_CONCURRENCY)
 
 async def safe_send_message(user_id:int, text:str, **kwargs):
     try:
-        return await bot.send_message(user_id, text, parse_mode="HTML", **kwargs)
+        async with _send_sem:
+            return await bot.send_message(user_id, text, parse_mode="HTML", **kwargs)
+    except tg_excs.TelegramRetryAfter as e:
+        # flood limit: wait out the window once, then give up quietly
+        await asyncio.sleep(e.retry_after)
+        try:
+            async with _send_sem:
+                return await bot.send_message(user_id, text, parse_mode="HTML", **kwargs)
+        except Exception as e2:
+            log.warning("safe_send_message retry failed for %s: %s", user_id, e2)
+            return None
     except tg_excs.TelegramForbiddenError:
         log.warning("Bot forbidden for user %s", user_id)
         return None
@@ -149,9 +391,63 @@ async def safe_send_message(user_id:int, text:str, **kwargs):
         log.exception("safe_send_message failed: %s", e)
         return None
 
+# ----------------------------
+# Telegram lookup caches: channels are stable (cache join URLs for hours),
+# membership flips occasionally (cache statuses briefly to absorb click spam)
+# ----------------------------
+CHAT_CACHE_TTL = 6 * 3600  # seconds
+_chat_cache: Dict[int, Any] = {}  # ch_id -> (expires_at, join_url)
+
+MEMBER_CACHE_TTL = 30  # seconds
+_member_cache: Dict[Any, Any] = {}  # (ch_id, user_id) -> (expires_at, status)
+
+async def get_join_url_cached(ch:int) -> str:
+    now_ts = time.time()
+    hit = _chat_cache.get(ch)
+    if hit and hit[0] > now_ts:
+        return hit[1]
+    try:
+        ch_info = await bot.get_chat(ch)
+        join_url = f"https://t.me/{ch_info.username}" if getattr(ch_info, "username", None) else f"https://t.me/c/{str(ch)[4:]}"
+    except Exception:
+        return "https://t.me/"  # transient failure; don't cache
+    _chat_cache[ch] = (now_ts + CHAT_CACHE_TTL, join_url)
+    return join_url
+
+async def get_member_status_cached(ch:int, user_id:int) -> str:
+    now_ts = time.time()
+    hit = _member_cache.get((ch, user_id))
+    if hit and hit[0] > now_ts:
+        return hit[1]
+    member = await bot.get_chat_member(ch, user_id)
+    _member_cache[(ch, user_id)] = (now_ts + MEMBER_CACHE_TTL, member.status)
+    return member.status
+
+MEMBER_CHECK_TRIES = 3
+
+async def get_member_status_retrying(ch:int, user_id:int) -> str:
+    # a 429 or network blip on one check shouldn't fail the whole delivery;
+    # retry with bounded backoff (~1s worst case) before giving up
+    delay = 0.1
+    for attempt in range(MEMBER_CHECK_TRIES):
+        try:
+            return await get_member_status_cached(ch, user_id)
+        except tg_excs.TelegramRetryAfter as e:
+            if attempt == MEMBER_CHECK_TRIES - 1:
+                raise
+            await asyncio.sleep(min(e.retry_after, 1.0))
+        except Exception:
+            if attempt == MEMBER_CHECK_TRIES - 1:
+                raise
+            await asyncio.sleep(delay)
+            delay *= 2
+
 # ----------------------------
 # Channel_post processing (auto-link)
 # ----------------------------
+# built once; per-post formatting only substitutes the two dynamic parts
+ADMIN_NEW_FILE_TMPL = "🎬 فایل جدید ثبت شد.\nToken: <code>{token}</code>\nDeep link: t.me/{username}?start={token}"
+
 async def process_channel_post(update: dict):
     cp = update.get("channel_post")
     if not cp:
@@ -178,16 +474,17 @@ async def process_channel_post(update: dict):
         return
 
     file_unique_id = file_obj.get("file_unique_id")
-    token = make_token(file_unique_id)
+    token = make_token()
 
     try:
-        fid = await insert_file_record(storage_chat_id=chat_id,
+        rec = await insert_file_record(storage_chat_id=chat_id,
                                        storage_message_id=message_id,
                                        file_unique_id=file_unique_id,
                                        file_type=file_type,
                                        file_size=file_size or 0,
                                        token=token,
                                        required_channels=DEFAULT_REQUIRED_CHANNEL_IDS)
+        fid, token = rec['id'], rec['token']
         log.info("Inserted file id=%s token=%s", fid, token)
     except Exception as e:
         log.exception("DB insert failed: %s", e)
@@ -195,50 +492,108 @@ async def process_channel_post(update: dict):
 
     # notify admins with deep link
     try:
-        me = await bot.get_me()
-        deep_link = f"t.me/{me.username}?start={token}"
-        text = f"🎬 فایل جدید ثبت شد.\nToken: <code>{token}</code>\nDeep link: {deep_link}"
-        for adm in ADMIN_IDS:
-            await safe_send_message(adm, text)
+        me = await get_me_cached()
+        text = ADMIN_NEW_FILE_TMPL.format(username=me.username, token=token)
+        # independent sends; fan out instead of paying one RTT per admin
+        await asyncio.gather(*(safe_send_message(adm, text) for adm in ADMIN_IDS), return_exceptions=True)
     except Exception as e:
         log.warning("notify admins failed: %s", e)
 
+# ----------------------------
+# Scheduled deletes: one worker drains a min-heap of deadlines instead of
+# one sleeping Task per delivery
+# ----------------------------
+_delete_heap: List[tuple] = []  # (deadline, seq, chat_id, msg_ids, delivery_id)
+_delete_seq = itertools.count()
+_delete_event = asyncio.Event()
+_delete_worker_task: Optional[asyncio.Task] = None
+
+def schedule_delete(chat_id:int, msg_ids:List[int], delivery_id:int, timeout:int):
+    heapq.heappush(_delete_heap, (time.time() + timeout, next(_delete_seq), chat_id, msg_ids, delivery_id))
+    _delete_event.set()
+
+async def expire_delivery(chat_id:int, msg_ids:List[int]):
+    try:
+        # one deleteMessages call instead of one RTT per message
+        await bot.delete_messages(chat_id, msg_ids)
+    except Exception as e:
+        log.warning("batch delete failed (%s); retrying individually", e)
+        for mid in msg_ids:
+            try:
+                await bot.delete_message(chat_id, mid)
+            except Exception as e2:
+                log.warning("delete message %s failed: %s", mid, e2)
+
+async def delete_worker():
+    while True:
+        if not _delete_heap:
+            _delete_event.clear()
+            await _delete_event.wait()
+            continue
+        wait_s = _delete_heap[0][0] - time.time()
+        if wait_s > 0:
+            # sleep until the earliest deadline, or until an earlier one arrives
+            _delete_event.clear()
+            try:
+                await asyncio.wait_for(_delete_event.wait(), timeout=wait_s)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        # drain everything already due so DB bookkeeping can be batched
+        due = []
+        now_ts = time.time()
+        while _delete_heap and _delete_heap[0][0] <= now_ts:
+            _, _, chat_id, msg_ids, delivery_id = heapq.heappop(_delete_heap)
+            due.append((chat_id, msg_ids, delivery_id))
+        # per-delivery deletes are independent Telegram calls; run them together
+        await asyncio.gather(*(expire_delivery(chat_id, msg_ids) for chat_id, msg_ids, _ in due),
+                             return_exceptions=True)
+        try:
+            await mark_deliveries_deleted([d for _, _, d in due])
+        except Exception as e:
+            log.warning("mark_deliveries_deleted failed: %s", e)
+
 # ----------------------------
 # /start <token> handling: forward + warning + scheduled delete
 # ----------------------------
 async def handle_start_message(msg: types.Message, token: str):
     uid = msg.from_user.id
 
-    if is_rate_limited(uid):
+    if await is_rate_limited(uid):
         await msg.answer("⛔ درخواست‌های شما زیاد شده؛ لطفا چند لحظه بعد تلاش کنید.")
         return
 
-    # upsert user
-    await upsert_user(uid, msg.from_user.username, msg.from_user.first_name, msg.from_user.last_name)
-
-    row = await get_file_by_token(token)
+    # upsert user + fetch file in one round-trip
+    row = await upsert_user_and_get_file(uid, msg.from_user.username, msg.from_user.first_name, msg.from_user.last_name, token)
     if not row:
         await msg.answer("❌ لینک نامعتبر یا منقضی شده.")
         return
 
-    # membership checks
+    # membership checks — independent lookups, so run them concurrently;
+    # required_channels is BIGINT[], so asyncpg already hands us ints
     req_channels = row.get("required_channels") or []
-    for ch in req_channels:
+    if req_channels:
+        # the chat_member mirror answers most checks with one DB round-trip;
+        # only channels it doesn't know about cost a Telegram call
         try:
-            member = await bot.get_chat_member(int(ch), uid)
-            if member.status in ("left", "kicked"):
-                try:
-                    ch_info = await bot.get_chat(int(ch))
-                    join_url = f"https://t.me/{ch_info.username}" if getattr(ch_info, "username", None) else f"https://t.me/c/{str(ch)[4:]}"
-                except Exception:
-                    join_url = "https://t.me/"
-                kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton("عضو شدن", url=join_url)]])
-                await msg.answer("برای دسترسی باید عضو کانال مورد نظر شوی.", reply_markup=kb)
-                return
+            known = await get_known_memberships(uid, req_channels)
         except Exception as e:
-            log.warning("get_chat_member failed: %s", e)
-            await msg.answer("خطا در بررسی عضویت — لطفا بعداً تلاش کنید.")
-            return
+            log.warning("membership mirror lookup failed: %s", e)
+            known = set()
+        req_channels = [ch for ch in req_channels if ch not in known]
+    if req_channels:
+        results = await asyncio.gather(
+            *(get_member_status_retrying(ch, uid) for ch in req_channels),
+            return_exceptions=True)
+        for ch, status in zip(req_channels, results):
+            if isinstance(status, BaseException):
+                log.warning("get_chat_member failed: %s", status)
+                await msg.answer("خطا در بررسی عضویت — لطفا بعداً تلاش کنید.")
+                return
+            if status in ("left", "kicked"):
+                join_url = await get_join_url_cached(ch)
+                await msg.answer("برای دسترسی باید عضو کانال مورد نظر شوی.", reply_markup=join_keyboard(join_url))
+                return
 
     # forward message
     try:
@@ -252,7 +607,7 @@ async def handle_start_message(msg: types.Message, token: str):
         return
 
     # warning message
-    timeout_setting = await get_setting('delete_timeout_seconds', str(DEFAULT_DELETE_TIMEOUT))
+    timeout_setting = await get_setting_cached('delete_timeout_seconds', str(DEFAULT_DELETE_TIMEOUT))
     try:
         timeout = int(timeout_setting)
     except Exception:
@@ -260,112 +615,258 @@ async def handle_start_message(msg: types.Message, token: str):
 
     warning = await msg.answer(f"⚠️ این پیام و فایل پس از {timeout} ثانیه حذف خواهد شد. سریعاً ذخیره یا فوروارد کنید.")
 
-    # record delivery + increment views
+    # record delivery + increment views (single round-trip)
     delivery_id = await record_delivery(row['id'], uid, forwarded.message_id if forwarded else None)
-    await increment_file_views(row['id'])
 
-    # schedule delete
-    async def do_delete():
-        await asyncio.sleep(timeout)
-        try:
-            if forwarded:
-                await bot.delete_message(uid, forwarded.message_id)
-        except Exception as e:
-            log.warning("delete forwarded failed: %s", e)
-        try:
-            await bot.delete_message(uid, warning.message_id)
-        except Exception as e:
-            log.warning("delete warning failed: %s", e)
-        try:
-            await mark_delivery_deleted(delivery_id)
-        except Exception as e:
-            log.warning("mark_delivery_deleted failed: %s", e)
-
-    asyncio.create_task(do_delete())
+    # schedule delete on the shared worker
+    msg_ids = [warning.message_id]
+    if forwarded:
+        msg_ids.append(forwarded.message_id)
+    schedule_delete(uid, msg_ids, delivery_id, timeout)
 
 # ----------------------------
 # Admin panel (simple inline)
 # ----------------------------
+# static keyboards are immutable; build them once at import time
+ADMIN_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📋 لیست لینک‌ها", callback_data="admin:list_links")],
+    [InlineKeyboardButton(text="⏱ تنظیم تایمر حذف", callback_data="admin:set_timer")],
+    [InlineKeyboardButton(text="📣 ارسال همگانی", callback_data="admin:broadcast")],
+    [InlineKeyboardButton(text="🔁 فعال/غیرفعال لینک", callback_data="admin:toggle_link")],
+])
+
+# join prompts repeat per channel; reuse the built markup per URL
+_join_kb_cache: Dict[str, InlineKeyboardMarkup] = {}
+
+def join_keyboard(join_url:str) -> InlineKeyboardMarkup:
+    kb = _join_kb_cache.get(join_url)
+    if kb is None:
+        kb = _join_kb_cache[join_url] = InlineKeyboardMarkup(
+            inline_keyboard=[[InlineKeyboardButton(text="عضو شدن", url=join_url)]])
+    return kb
+
 async def send_admin_panel(chat_id:int):
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton("📋 لیست لینک‌ها", callback_data="admin:list_links")],
-        [InlineKeyboardButton("⏱ تنظیم تایمر حذف", callback_data="admin:set_timer")],
-        [InlineKeyboardButton("📣 ارسال همگانی", callback_data="admin:broadcast")],
-        [InlineKeyboardButton("🔁 فعال/غیرفعال لینک", callback_data="admin:toggle_link")],
-    ])
-    await safe_send_message(chat_id, "📌 پنل مدیریت:", reply_markup=kb)
-
-async def admin_list_links(chat_id:int):
-    pool = await get_db_pool()
+    await safe_send_message(chat_id, "📌 پنل مدیریت:", reply_markup=ADMIN_KB)
+
+ADMIN_LIST_PAGE_SIZE = 30
+ADMIN_LIST_CACHE_TTL = 5  # seconds; absorbs rapid repeat clicks
+_links_page_cache: Dict[Optional[str], Any] = {}  # cursor -> (expires_at, text, next_cursor)
+
+async def admin_list_links(chat_id:int, before:Optional[str]=None):
+    now_ts = time.time()
+    hit = _links_page_cache.get(before)
+    if hit and hit[0] > now_ts:
+        chunk, next_cursor = hit[1], hit[2]
+    else:
+        pool = await get_pool()
+        async with pool.acquire() as conn:
+            if before:
+                rows = await conn.fetch(
+                    "SELECT id, token, created_at, views, active FROM files WHERE created_at < $1 ORDER BY created_at DESC LIMIT $2",
+                    datetime.fromisoformat(before), ADMIN_LIST_PAGE_SIZE)
+            else:
+                rows = await conn.fetch(
+                    "SELECT id, token, created_at, views, active FROM files ORDER BY created_at DESC LIMIT $1",
+                    ADMIN_LIST_PAGE_SIZE)
+        if not rows:
+            await safe_send_message(chat_id, "هیچ لینکی ثبت نشده." if not before else "لینک دیگری وجود ندارد.")
+            return
+        chunk = "\n\n".join(
+            f"ID: {r['id']}  token: <code>{r['token']}</code>\nviews: {r['views']} active: {r['active']}"
+            for r in rows
+        )
+        if len(chunk) > 3900:
+            chunk = chunk[:3900] + "\n…"
+        next_cursor = rows[-1]['created_at'].isoformat() if len(rows) == ADMIN_LIST_PAGE_SIZE else None
+        _links_page_cache[before] = (now_ts + ADMIN_LIST_CACHE_TTL, chunk, next_cursor)
+    kb = None
+    if next_cursor:
+        kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬇️ صفحه بعد", callback_data=f"admin:list_links:{next_cursor}")]])
+    await safe_send_message(chat_id, chunk, reply_markup=kb)
+
+# broadcast flow: the admin's next message resolves a Future instead of a
+# polled flag; the waiter expires on its own after 5 minutes
+BROADCAST_WAIT_TIMEOUT = 300  # seconds
+_broadcast_waiters: Dict[int, asyncio.Future] = {}
+
+SQL_BROADCAST_NEW_RUN = "INSERT INTO broadcast_runs (message) VALUES ($1) RETURNING id"
+SQL_BROADCAST_RECIPIENTS = """
+    SELECT user_id FROM users
+    WHERE blocked=false
+      AND NOT EXISTS (SELECT 1 FROM broadcast_sent b WHERE b.run_id=$1 AND b.user_id = users.user_id)
+"""
+SQL_BROADCAST_MARK = "INSERT INTO broadcast_sent (run_id, user_id) VALUES ($1,$2) ON CONFLICT DO NOTHING"
+SQL_BROADCAST_COMPLETE = "UPDATE broadcast_runs SET completed_at = now() WHERE id=$1"
+SQL_BROADCAST_UNFINISHED = "SELECT id, message FROM broadcast_runs WHERE completed_at IS NULL ORDER BY id DESC LIMIT 1"
+
+# Telegram's broadcast allowance is ~30 msg/s; stay under it with headroom
+BROADCAST_RATE = int(os.getenv("BROADCAST_RATE", "25"))  # msg/s
+
+async def _broadcast_send(user_id: int, text: str):
+    # True: delivered. False: permanent failure (user blocked the bot) —
+    # marking it stops pointless retries. None: transient failure — leave
+    # unmarked so a resumed run tries again.
+    try:
+        async with _send_sem:
+            await bot.send_message(user_id, text, parse_mode="HTML")
+        return True
+    except tg_excs.TelegramRetryAfter as e:
+        await asyncio.sleep(e.retry_after)
+        try:
+            async with _send_sem:
+                await bot.send_message(user_id, text, parse_mode="HTML")
+            return True
+        except tg_excs.TelegramForbiddenError:
+            return False
+        except Exception:
+            return None
+    except tg_excs.TelegramForbiddenError:
+        return False
+    except Exception as e:
+        log.warning("broadcast send failed for %s: %s", user_id, e)
+        return None
+
+async def _send_broadcast_page(run_id: int, content: str, batch: List[int]) -> int:
+    # the send semaphore caps concurrency, not rate: pace each page in
+    # BROADCAST_RATE-sized slices, one slice per second at most
+    count = 0
+    settled: List[Any] = []
+    for i in range(0, len(batch), BROADCAST_RATE):
+        group = batch[i:i + BROADCAST_RATE]
+        started = time.monotonic()
+        results = await asyncio.gather(*(_broadcast_send(u, content) for u in group))
+        for u, res in zip(group, results):
+            if res is not None:
+                settled.append((run_id, u))
+            if res:
+                count += 1
+        elapsed = time.monotonic() - started
+        if i + BROADCAST_RATE < len(batch) and elapsed < 1.0:
+            await asyncio.sleep(1.0 - elapsed)
+    # mark only recipients with a known outcome, after the sends: a crash
+    # mid-page re-sends at most one page, and flood-limited users stay
+    # unmarked so a resume reaches them
+    if settled:
+        pool = await get_pool()
+        async with pool.acquire() as conn:
+            await conn.executemany(SQL_BROADCAST_MARK, settled)
+    return count
+
+async def _broadcast_pages(run_id: int, content: str) -> int:
+    count = 0
+    pool = await get_pool()
+    # stream recipients through a server-side cursor and send each page as
+    # a gathered batch: peak memory stays O(prefetch) instead of O(users).
+    # Pinning one pool connection is fine here — broadcasts are rare.
     async with pool.acquire() as conn:
-        rows = await conn.fetch("SELECT id, token, created_at, views, active FROM files ORDER BY created_at DESC LIMIT 200")
-    if not rows:
-        await safe_send_message(chat_id, "هیچ لینکی ثبت نشده.")
+        async with conn.transaction():
+            batch: List[int] = []
+            async for r in conn.cursor(SQL_BROADCAST_RECIPIENTS, run_id, prefetch=1000):
+                batch.append(r['user_id'])
+                if len(batch) >= 1000:
+                    count += await _send_broadcast_page(run_id, content, batch)
+                    batch.clear()
+            if batch:
+                count += await _send_broadcast_page(run_id, content, batch)
+    return count
+
+async def run_broadcast(admin_id: int, content: str):
+    pool = await get_pool()
+    run_id = (await pool.fetchrow(SQL_BROADCAST_NEW_RUN, content))['id']
+    count = await _broadcast_pages(run_id, content)
+    await pool.execute(SQL_BROADCAST_COMPLETE, run_id)
+    await safe_send_message(admin_id, f"✅ پیام ارسال شد تقریبا به {count} کاربر.")
+
+async def resume_unfinished_broadcast():
+    # a crash mid-broadcast leaves completed_at NULL; pick the run back up at
+    # startup — broadcast_sent makes the re-run skip everyone already reached
+    try:
+        pool = await get_pool()
+        row = await pool.fetchrow(SQL_BROADCAST_UNFINISHED)
+        if not row:
+            return
+        log.info("Resuming unfinished broadcast run %s", row['id'])
+        count = await _broadcast_pages(row['id'], row['message'])
+        await pool.execute(SQL_BROADCAST_COMPLETE, row['id'])
+        await asyncio.gather(
+            *(safe_send_message(a, f"✅ ارسال همگانی ناتمام ادامه یافت و تقریبا به {count} کاربر دیگر رسید.") for a in ADMIN_IDS),
+            return_exceptions=True)
+    except Exception as e:
+        log.warning("broadcast resume failed: %s", e)
+
+_broadcast_resume_task: Optional[asyncio.Task] = None
+# strong references so the flow tasks can't be garbage-collected mid-wait
+_broadcast_tasks: set = set()
+
+async def broadcast_flow(admin_id: int):
+    fut: asyncio.Future = asyncio.get_running_loop().create_future()
+    _broadcast_waiters[admin_id] = fut
+    try:
+        content = await asyncio.wait_for(fut, timeout=BROADCAST_WAIT_TIMEOUT)
+    except asyncio.TimeoutError:
         return
-    texts = []
-    for r in rows:
-        texts.append(f"ID: {r['id']}  token: <code>{r['token']}</code>\nviews: {r['views']} active: {r['active']}")
-    # send chunked if too long
-    chunk = "\n\n".join(texts)
-    if len(chunk) > 3900:
-        chunk = chunk[:3900] + "\n…"
-    await safe_send_message(chat_id, chunk)
-
-# broadcast simple state
-_broadcast_waiting_for: Dict[int, bool] = {}
+    finally:
+        # only remove our own future: a second button press replaces the
+        # entry, and this flow's timeout must not evict the newer waiter
+        if _broadcast_waiters.get(admin_id) is fut:
+            _broadcast_waiters.pop(admin_id, None)
+    await run_broadcast(admin_id, content)
+
+def start_broadcast_flow(admin_id: int):
+    task = asyncio.create_task(broadcast_flow(admin_id))
+    _broadcast_tasks.add(task)
+    task.add_done_callback(_broadcast_tasks.discard)
 
 # ----------------------------
 # Aiogram handlers (catch-all)
 # ----------------------------
+# command routing goes through aiogram's precompiled filters instead of
+# startswith-chains inside one catch-all handler
+@dp.message(CommandStart(deep_link=True))
+async def start_with_token(msg: types.Message, command: CommandObject):
+    await handle_start_message(msg, (command.args or "").strip())
+
+@dp.message(CommandStart())
+async def start_plain(msg: types.Message):
+    await msg.answer("سلام! برای دریافت فایل از لینک‌هایی که به شما داده شده استفاده کنید.")
+
+@dp.message(Command("admin"))
+async def admin_command(msg: types.Message):
+    uid = msg.from_user.id
+    if uid not in ADMIN_IDS:
+        await msg.answer("⛔ شما دسترسی ندارید")
+        return
+    await send_admin_panel(uid)
+
 @dp.message()
 async def all_messages(msg: types.Message):
     text = (msg.text or "").strip()
     uid = msg.from_user.id
 
-    # /start token
-    if text.startswith("/start"):
-        parts = text.split(maxsplit=1)
-        if len(parts) == 2:
-            token = parts[1].strip()
-            await handle_start_message(msg, token)
-            return
-        await msg.answer("سلام! برای دریافت فایل از لینک‌هایی که به شما داده شده استفاده کنید.")
-        return
-
-    # admin
-    if text.startswith("/admin"):
-        if uid not in ADMIN_IDS:
-            await msg.answer("⛔ شما دسترسی ندارید")
-            return
-        await send_admin_panel(uid)
-        return
-
     # admin setting number => set timer
     if uid in ADMIN_IDS and text.isdigit():
         await set_setting('delete_timeout_seconds', text)
         await msg.answer(f"✅ تایمر حذف روی {text} ثانیه تنظیم شد.")
         return
 
-    # broadcast reply flow
-    if _broadcast_waiting_for.get(uid) and uid in ADMIN_IDS:
-        content = msg.text or ""
-        pool = await get_db_pool()
-        async with pool.acquire() as conn:
-            rows = await conn.fetch("SELECT user_id FROM users WHERE blocked=false")
-        count = 0
-        for r in rows:
-            try:
-                await safe_send_message(r['user_id'], content)
-                count += 1
-                await asyncio.sleep(0.05)
-            except Exception:
-                continue
-        _broadcast_waiting_for.pop(uid, None)
-        await msg.answer(f"✅ پیام ارسال شد تقریبا به {count} کاربر.")
+    # broadcast reply flow: hand the text to the waiting Future
+    fut = _broadcast_waiters.get(uid)
+    if fut is not None and not fut.done() and uid in ADMIN_IDS:
+        fut.set_result(msg.text or "")
         return
 
     await msg.answer("✅ Bot is on!")
 
+@dp.chat_member()
+async def chat_member_changed(update: types.ChatMemberUpdated):
+    # keep the membership mirror current so /start can skip get_chat_member
+    status = update.new_chat_member.status
+    is_member = status in ("member", "administrator", "creator")
+    try:
+        await set_membership(update.chat.id, update.new_chat_member.user.id, is_member)
+    except Exception as e:
+        log.warning("membership mirror update failed: %s", e)
+
 @dp.callback_query()
 async def callback_handler(cq: types.CallbackQuery):
     uid = cq.from_user.id
@@ -373,15 +874,16 @@ async def callback_handler(cq: types.CallbackQuery):
         await cq.answer("⛔ دسترسی ندارید", show_alert=True)
         return
     data = cq.data or ""
-    if data == "admin:list_links":
-        await admin_list_links(uid)
+    if data.startswith("admin:list_links"):
+        _, _, cursor = data.partition("admin:list_links:")
+        await admin_list_links(uid, before=cursor or None)
         await cq.answer()
         return
     if data == "admin:set_timer":
         await cq.answer("عدد ثانیه جدید را ارسال کنید (مثال: 20).", show_alert=True)
         return
     if data == "admin:broadcast":
-        _broadcast_waiting_for[uid] = True
+        start_broadcast_flow(uid)
         await cq.answer("لطفا پیام را ارسال کنید تا برای همه ارسال شود.", show_alert=True)
         return
     if data == "admin:toggle_link":
@@ -394,39 +896,74 @@ async def callback_handler(cq: types.CallbackQuery):
 # ----------------------------
 app = FastAPI()
 
+# ACK Telegram before running handlers: it won't ship the next update until
+# we respond, so awaiting the dispatcher caps throughput at one update per
+# slowest-handler. The in-flight set keeps strong task references and bounds
+# queued work; over the cap we shed with 503 and Telegram redelivers.
+MAX_INFLIGHT_UPDATES = int(os.getenv("MAX_INFLIGHT_UPDATES", "500"))
+MAX_WEBHOOK_BODY = int(os.getenv("MAX_WEBHOOK_BODY", str(1024 * 1024)))  # bytes
+_inflight: set = set()
+
+async def _dispatch_update(data: dict):
+    try:
+        await dp.feed_raw_update(bot, data)
+    except Exception as e:
+        log.exception("feed_raw_update failed: %s", e)
+
+def _spawn_tracked(coro) -> bool:
+    # all webhook-spawned work goes through here: strong references plus the
+    # in-flight cap apply to channel_post processing and dispatch alike
+    if len(_inflight) >= MAX_INFLIGHT_UPDATES:
+        coro.close()
+        return False
+    task = asyncio.create_task(coro)
+    _inflight.add(task)
+    task.add_done_callback(_inflight.discard)
+    return True
+
 @app.post(WEBHOOK_PATH)
-async def webhook(request: Request):
+async def webhook(request: Request, x_telegram_bot_api_secret_token: Optional[str] = Header(None)):
+    # Telegram echoes the secret_token we registered; drop anything else
+    # before spending any parsing/dispatch work on it
+    # compare as bytes: compare_digest on str raises TypeError for non-ASCII,
+    # and headers arrive latin-1-decoded, so a high-byte scraper value would
+    # otherwise turn the cheap 403 into a 500
+    if not x_telegram_bot_api_secret_token or not hmac.compare_digest(
+            x_telegram_bot_api_secret_token.encode("utf-8", "surrogateescape"),
+            _WEBHOOK_SECRET_BYTES):
+        return ORJSONResponse({"ok": False}, status_code=403)
+    # Telegram updates are small; refuse oversized bodies before reading them
+    content_length = request.headers.get("content-length")
+    if content_length and (not content_length.isdigit() or int(content_length) > MAX_WEBHOOK_BODY):
+        return ORJSONResponse({"ok": False, "error": "payload too large"}, status_code=413)
     try:
-        data = await request.json()
+        data = orjson.loads(await request.body())
     except Exception:
-        return JSONResponse({"ok": False, "error": "invalid json"}, status_code=400)
+        return ORJSONResponse({"ok": False, "error": "invalid json"}, status_code=400)
 
-    # fast path for channel_post: schedule processing in background and reply quickly
+    # fast path for channel_post: process_channel_post reads the raw dict and
+    # no dispatcher handler subscribes to channel_post, so skip aiogram's
+    # Update validation for these entirely
     if "channel_post" in data:
-        asyncio.create_task(process_channel_post(data))
-        # still feed update to dispatcher to keep internal handlers sane
-        try:
-            update = types.Update(**data)
-            await dp.feed_update(bot, update)
-        except Exception:
-            pass
-        return JSONResponse({"ok": True})
+        if not _spawn_tracked(process_channel_post(data)):
+            return ORJSONResponse({"ok": False}, status_code=503)
+        return ORJSONResponse({"ok": True})
 
-    # other updates: feed to aiogram dispatcher
-    try:
-        update = types.Update(**data)
-        await dp.feed_update(bot, update)
-    except Exception as e:
-        log.exception("feed_update failed: %s", e)
-    return JSONResponse({"ok": True})
+    if not _spawn_tracked(_dispatch_update(data)):
+        return ORJSONResponse({"ok": False}, status_code=503)
+    return ORJSONResponse({"ok": True})
+
+# probes fire every few seconds; serve pre-encoded bytes, no JSON work
+_HEALTH_OK = b'{"status":"ok"}'
+_HEALTH_FORBIDDEN = b'{"status":"forbidden"}'
 
-@app.get("/health")
+@app.api_route("/health", methods=["GET", "HEAD"])
 async def health(x_keepalive_secret: Optional[str] = Header(None)):
     # protect health with secret if set
     if KEEPALIVE_SECRET:
         if not x_keepalive_secret or x_keepalive_secret != KEEPALIVE_SECRET:
-            return JSONResponse({"status":"forbidden"}, status_code=403)
-    return JSONResponse({"status":"ok"})
+            return Response(content=_HEALTH_FORBIDDEN, status_code=403, media_type="application/json")
+    return Response(content=_HEALTH_OK, media_type="application/json")
 
 # ----------------------------
 # Startup / Shutdown
@@ -434,7 +971,38 @@ async def health(x_keepalive_secret: Optional[str] = Header(None)):
 @app.on_event("startup")
 async def on_startup():
     log.info("Startup: init DB pool")
-    await get_db_pool()
+    await init_db()
+    try:
+        await get_me_cached()
+    except Exception as e:
+        log.warning("get_me failed at startup: %s", e)
+    # warm the join-URL cache so even the first non-member /start skips get_chat
+    for ch in DEFAULT_REQUIRED_CHANNEL_IDS:
+        await get_join_url_cached(ch)
+    global _rate_sweeper_task, _delete_worker_task, _view_flusher_task
+    _rate_sweeper_task = asyncio.create_task(sweep_rate_map())
+    _delete_worker_task = asyncio.create_task(delete_worker())
+    _view_flusher_task = asyncio.create_task(view_flusher())
+    global _broadcast_resume_task
+    _broadcast_resume_task = asyncio.create_task(resume_unfinished_broadcast())
+    global _settings_listen_conn
+    try:
+        _settings_listen_conn = await asyncpg.connect(DATABASE_URL)
+        await _settings_listen_conn.add_listener('settings_changed', _on_settings_changed)
+    except Exception as e:
+        log.warning("settings LISTEN unavailable, relying on cache TTL: %s", e)
+    if REDIS_URL and aioredis is not None:
+        global _redis, _rate_limit_script
+        try:
+            # short timeouts: a Redis outage must cost a limiter check
+            # milliseconds, not an OS-level TCP connect timeout per /start
+            _redis = aioredis.from_url(REDIS_URL,
+                                       socket_connect_timeout=0.5,
+                                       socket_timeout=0.5)
+            _rate_limit_script = _redis.register_script(_RATE_LIMIT_LUA)
+            log.info("Redis rate limiting enabled")
+        except Exception as e:
+            log.warning("Redis init failed, using in-process rate limiter: %s", e)
     # set webhook
     if WEBHOOK_URL:
         try:
@@ -442,7 +1010,9 @@ async def on_startup():
         except Exception:
             pass
         try:
-            await bot.set_webhook(WEBHOOK_URL, allowed_updates=["message","channel_post","callback_query","chat_member"])
+            await bot.set_webhook(WEBHOOK_URL,
+                                  allowed_updates=["message","channel_post","callback_query","chat_member"],
+                                  secret_token=WEBHOOK_SECRET)
             log.info("Webhook set: %s", WEBHOOK_URL)
         except Exception as e:
             log.exception("Failed to set webhook: %s", e)
@@ -452,14 +1022,30 @@ async def on_startup():
 @app.on_event("shutdown")
 async def on_shutdown():
     log.info("Shutting down")
+    for task in (_rate_sweeper_task, _delete_worker_task, _view_flusher_task):
+        if task is not None:
+            task.cancel()
+    try:
+        await _flush_views_once()
+    except Exception:
+        pass
     try:
         await bot.delete_webhook()
     except Exception:
         pass
     await bot.session.close()
-    global _db_pool
-    if _db_pool:
-        await _db_pool.close()
+    if _settings_listen_conn is not None:
+        try:
+            await _settings_listen_conn.close()
+        except Exception:
+            pass
+    if _redis is not None:
+        try:
+            await _redis.close()
+        except Exception:
+            pass
+    await close_pool()
+    _log_listener.stop()
 
 # ----------------------------
 # Run (uvicorn via Render start command)
@@ -467,4 +1053,4 @@ async def on_shutdown():
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", "8000"))
-    uvicorn.run("main:app", host="0.0.0.0", port=port, log_level="info")
+    uvicorn.run("main:app", host="0.0.0.0", port=port, log_level="info", loop="uvloop")
@@ -31,6 +31,13 @@ CREATE TABLE IF NOT EXISTS files (
   created_at TIMESTAMPTZ NOT NULL DEFAULT now()
 );
 
+-- عضویت کاربران در کانال‌های اجباری (از آپدیت‌های chat_member پر می‌شود)
+CREATE TABLE IF NOT EXISTS channel_members (
+  channel_id BIGINT NOT NULL,
+  user_id BIGINT NOT NULL,
+  PRIMARY KEY (channel_id, user_id)
+);
+
 -- آمار تحویل هر ارسال
 CREATE TABLE IF NOT EXISTS deliveries (
   id BIGSERIAL PRIMARY KEY,
@@ -41,9 +48,28 @@ CREATE TABLE IF NOT EXISTS deliveries (
   deleted_at TIMESTAMPTZ
 );
 
+-- اجراهای ارسال همگانی؛ ثبت هر گیرنده پیش از ارسال، برای ازسرگیری بدون تکرار
+CREATE TABLE IF NOT EXISTS broadcast_runs (
+  id BIGSERIAL PRIMARY KEY,
+  message TEXT NOT NULL,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  completed_at TIMESTAMPTZ  -- NULL یعنی اجرا ناتمام مانده و هنگام راه‌اندازی ادامه می‌یابد
+);
+
+CREATE TABLE IF NOT EXISTS broadcast_sent (
+  run_id BIGINT NOT NULL REFERENCES broadcast_runs(id) ON DELETE CASCADE,
+  user_id BIGINT NOT NULL,
+  PRIMARY KEY (run_id, user_id)
+);
+
 -- ایندکس‌ها
-CREATE INDEX IF NOT EXISTS idx_files_token ON files (token);
+-- هر فایل فقط یک ردیف دارد؛ ارسال مجدد همان فایل ردیف قبلی را به‌روز می‌کند
+CREATE UNIQUE INDEX IF NOT EXISTS idx_files_file_unique_id ON files (file_unique_id);
+-- لوکاپ توکن فقط روی ردیف‌های فعال انجام می‌شود (ایندکس جزئی)
+CREATE INDEX IF NOT EXISTS idx_files_token_active ON files (token) WHERE active;
 CREATE INDEX IF NOT EXISTS idx_files_created_at ON files (created_at DESC);
+-- اسکن گیرندگان ارسال همگانی فقط کاربران غیرمسدود را می‌خواند (ایندکس جزئی)
+CREATE INDEX IF NOT EXISTS idx_users_not_blocked ON users (user_id) WHERE NOT blocked;
 CREATE INDEX IF NOT EXISTS idx_deliveries_file_id ON deliveries (file_id);
 CREATE INDEX IF NOT EXISTS idx_deliveries_user_id ON deliveries (user_id);
 